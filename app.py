@@ -1,9 +1,32 @@
+# Patch the stdlib before anything else imports socket/ssl/threading so that
+# Gemini calls and MongoDB I/O yield to other greenlets under the gevent worker.
+from gevent import monkey
+monkey.patch_all()
+
 import os
 import json
+import logging
+import queue
+import threading
+import time
+import orjson
+import ijson
+from functools import lru_cache
+from types import MappingProxyType
 from flask import Flask, render_template, request, jsonify
-import requests
+from flask.json.provider import DefaultJSONProvider
+import httpx
 from datetime import datetime
-from pymongo import MongoClient
+from pymongo import MongoClient, DESCENDING
+from pymongo.errors import BulkWriteError, PyMongoError
+
+# --- Logging ---
+# Lazy %-style formatting means debug payload dumps cost nothing unless
+# LOG_LEVEL=DEBUG is set.
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
+logger = logging.getLogger(__name__)
+# httpx logs every request URL at INFO; keep only its warnings.
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # --- Configuration ---
 # Get secrets from Render's environment variables
@@ -12,107 +35,365 @@ MONGO_URI = os.environ.get("MONGO_URI")
 
 # --- Database Setup ---
 if not MONGO_URI:
-    print("FATAL ERROR: MONGO_URI is not set in the environment.")
+    logger.critical("FATAL ERROR: MONGO_URI is not set in the environment.")
     # Exit or handle gracefully if the URI is not found
     # For simplicity, we'll let it fail on connection attempt
     
-client = MongoClient(MONGO_URI)
+# Appointment inserts only need primary acknowledgment (w=1), and a bounded
+# pool with short timeouts keeps workers from piling up on a slow cluster.
+client = MongoClient(
+    MONGO_URI,
+    maxPoolSize=50,
+    minPoolSize=5,
+    waitQueueTimeoutMS=2000,
+    serverSelectionTimeoutMS=3000,
+    retryWrites=True,
+    w=1,
+    compressors="zstd,zlib",
+    connect=False,
+)
 db = client.ai_companion_db # Your database name
 appointments_collection = db.appointments # Your collection (table) name
 
+def _warm_up_database():
+    """Opens the first pooled connection and ensures the appointments index exists."""
+    try:
+        client.admin.command('ping')
+        appointments_collection.create_index([('bookingTimestampUTC', DESCENDING)])
+    except PyMongoError as e:
+        logger.warning("Could not warm up MongoDB connection: %s", e)
+
+# Warm up in the background so an unreachable cluster doesn't stall every
+# worker's boot on the server-selection timeout.
+threading.Thread(target=_warm_up_database, name="mongo-warm-up", daemon=True).start()
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider that runs jsonify and request.json through orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 # Initialize the Flask application
 app = Flask(__name__, template_folder='.')
+app.json = OrjsonProvider(app)
+
+# --- HTTP Client Setup ---
+# One long-lived HTTP/2 client per process so every Gemini call is multiplexed
+# over the same keep-alive connection (with HPACK header compression) instead
+# of paying a fresh TCP + TLS handshake.
+# Google APIs only gzip responses when the User-Agent also contains "gzip".
+HTTP_CLIENT = httpx.Client(
+    headers={'Accept-Encoding': 'gzip', 'User-Agent': 'medicure-aichat (gzip)'},
+    timeout=httpx.Timeout(20.0, connect=3.0),
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+    ),
+)
+
+# --- Appointment Write Buffer ---
+# /process only enqueues the appointment; a daemon thread drains the queue and
+# writes up to APPT_BATCH_SIZE documents per insert_many, waiting at most
+# APPT_FLUSH_INTERVAL seconds to fill a batch. Documents that fail to insert are
+# retried with backoff; any still unsaved after APPT_WRITE_RETRIES are appended
+# to a local dead-letter .ndjson file so they can be re-imported by hand.
+# Patient details stay out of the logs, which only get the count and _ids.
+# Trade-off: /process has already answered by then, and if the worker crashes,
+# appointments still in the buffer (at most ~200 ms worth) are lost.
+APPT_QUEUE = queue.Queue()
+APPT_BATCH_SIZE = 100
+APPT_FLUSH_INTERVAL = 0.2
+APPT_WRITE_RETRIES = 5
+APPT_RETRY_BACKOFF = 0.5
+APPT_DEAD_LETTER_PATH = os.environ.get("APPT_DEAD_LETTER_PATH", "unsaved_appointments.ndjson")
+DUPLICATE_KEY_ERROR = 11000
+
+def _dead_letter_appointments(batch):
+    """Appends unsaved appointments to the dead-letter file, one JSON document per line."""
+    lines = b"".join(orjson.dumps(appointment, default=str) + b"\n" for appointment in batch)
+    try:
+        # A single append-mode write keeps lines from different workers intact.
+        with open(APPT_DEAD_LETTER_PATH, "ab") as dead_letter:
+            dead_letter.write(lines)
+    except OSError as e:
+        logger.critical("Could not write %d unsaved appointments to %s: %s", len(batch), APPT_DEAD_LETTER_PATH, e)
+        return
+    logger.error("Wrote %d unsaved appointments to %s; _ids: %s", len(batch), APPT_DEAD_LETTER_PATH,
+                 ", ".join(str(appointment.get('_id')) for appointment in batch))
+
+def _insert_appointments(batch):
+    """Inserts a batch, retrying only the documents that failed; returns those never saved."""
+    for attempt in range(APPT_WRITE_RETRIES + 1):
+        if attempt:
+            time.sleep(APPT_RETRY_BACKOFF * 2 ** (attempt - 1))
+        try:
+            insert_result = appointments_collection.insert_many(batch, ordered=False)
+            logger.info("Saved %d appointments to MongoDB", len(insert_result.inserted_ids))
+            return []
+        except BulkWriteError as e:
+            # insert_many assigns _id before sending, so a duplicate key means an
+            # earlier attempt already stored that document.
+            write_errors = e.details.get('writeErrors', [])
+            failed = [batch[err['index']] for err in write_errors if err.get('code') != DUPLICATE_KEY_ERROR]
+            logger.warning("Saved %d of %d appointments to MongoDB; %d failed", len(batch) - len(failed), len(batch), len(failed))
+            batch = failed
+            if not batch:
+                return []
+        except PyMongoError as e:
+            logger.warning("Failed to save %d appointments to MongoDB (attempt %d): %s", len(batch), attempt + 1, e)
+    return batch
+
+def _flush_appointments():
+    """Batches queued appointments into MongoDB; runs forever on a daemon thread."""
+    while True:
+        batch = [APPT_QUEUE.get()]
+        deadline = time.monotonic() + APPT_FLUSH_INTERVAL
+        while len(batch) < APPT_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(APPT_QUEUE.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            unsaved = _insert_appointments(batch)
+        except Exception as e:
+            logger.error("Unexpected error saving %d appointments to MongoDB: %s", len(batch), e)
+            unsaved = batch
+        if unsaved:
+            _dead_letter_appointments(unsaved)
+
+threading.Thread(target=_flush_appointments, name="appointment-writer", daemon=True).start()
+
+# --- Gemini Circuit Breaker ---
+# After GEMINI_FAIL_MAX consecutive upstream failures (timeouts, network errors,
+# 5xx and 429), Gemini calls fail fast for GEMINI_RESET_TIMEOUT seconds instead
+# of tying up workers on a degraded upstream. Other 4xx responses mean Gemini is
+# reachable and don't count. Once the timeout passes, a single probe call is
+# let through (half-open): success closes the breaker, failure re-opens it.
+GEMINI_FAIL_MAX = 5
+GEMINI_RESET_TIMEOUT = 30
+_breaker_lock = threading.Lock()
+_breaker_failures = 0
+_breaker_opened_at = 0.0
+_breaker_probe_in_flight = False
+
+class GeminiUnavailableError(ConnectionError):
+    """Raised without contacting Gemini while the circuit breaker is open."""
+
+class GeminiUpstreamError(ConnectionError):
+    """Raised when Gemini itself is failing, as opposed to rejecting our request."""
+
+def _breaker_allows_call():
+    global _breaker_probe_in_flight
+    with _breaker_lock:
+        if _breaker_failures < GEMINI_FAIL_MAX:
+            return True
+        if _breaker_probe_in_flight or time.monotonic() - _breaker_opened_at < GEMINI_RESET_TIMEOUT:
+            return False
+        _breaker_probe_in_flight = True
+        return True
+
+def _breaker_record(success):
+    global _breaker_failures, _breaker_opened_at, _breaker_probe_in_flight
+    with _breaker_lock:
+        _breaker_probe_in_flight = False
+        if success:
+            _breaker_failures = 0
+            return
+        _breaker_failures += 1
+        if _breaker_failures >= GEMINI_FAIL_MAX:
+            _breaker_opened_at = time.monotonic()
 
 # --- Gemini API Helper Function ---
-# (This function remains unchanged from the previous version)
+GEMINI_RETRIES = 3
+GEMINI_RETRY_BACKOFF = 0.2
+GEMINI_RETRY_STATUSES = (502, 503, 504)
+
 def make_gemini_api_call(payload):
-    """Makes a request to the Gemini API and returns the JSON response."""
+    """Makes a request to the Gemini API through the circuit breaker and returns the JSON response."""
+    if not _breaker_allows_call():
+        logger.warning("Gemini circuit breaker is open; failing fast.")
+        raise GeminiUnavailableError("Gemini temporarily unavailable. Please try again shortly.")
+    upstream_failed = False
+    try:
+        return _send_gemini_request(payload)
+    except GeminiUpstreamError:
+        upstream_failed = True
+        raise
+    finally:
+        _breaker_record(success=not upstream_failed)
+
+def _send_gemini_request(payload):
+    """Sends one request to the Gemini API and returns the parsed AI JSON."""
     if not API_KEY:
-        print("ERROR: Gemini API key is not set in the environment.")
+        logger.error("Gemini API key is not set in the environment.")
         raise ValueError("Gemini API key is not configured on the server.")
     
-    api_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:generateContent?key={API_KEY}"
+    api_url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:generateContent"
+    # The key goes in a header so it never appears in logged URLs or error messages.
+    headers = {'Content-Type': 'application/json', 'x-goog-api-key': API_KEY}
     
-    print("\n--- Sending Payload to Gemini ---")
-    print(json.dumps(payload, indent=2))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Sending payload to Gemini: %s", orjson.dumps(payload).decode())
     
     try:
-        response = requests.post(api_url, json=payload, headers={'Content-Type': 'application/json'})
-        
-        print("\n--- Received Response from Gemini ---")
-        print(f"Status Code: {response.status_code}")
-        print("Response Body:")
-        print(response.text)
-        
-        response.raise_for_status()
+        body = orjson.dumps(payload)
+        # Transient 502/503/504s (e.g. "model overloaded") are retried with
+        # backoff before they are reported as errors. Each response body is
+        # streamed through ijson, stopping at the first candidate's text, so
+        # the full response envelope is never materialized as Python objects.
+        for attempt in range(GEMINI_RETRIES + 1):
+            if attempt:
+                time.sleep(GEMINI_RETRY_BACKOFF * 2 ** (attempt - 1))
+            with HTTP_CLIENT.stream("POST", api_url, content=body, headers=headers) as response:
+                if response.status_code in GEMINI_RETRY_STATUSES and attempt < GEMINI_RETRIES:
+                    logger.warning("Gemini returned %d; retrying (%d of %d)", response.status_code, attempt + 1, GEMINI_RETRIES)
+                    continue
 
-        result = response.json()
-        
-        ai_response_text = result['candidates'][0]['content']['parts'][0]['text']
-        return json.loads(ai_response_text)
+                if response.is_error:
+                    response.read()
+                    logger.error("Gemini error response (status %d): %s", response.status_code, response.text)
+                elif logger.isEnabledFor(logging.DEBUG):
+                    response.read()
+                    logger.debug("Gemini response body: %s", response.text)
+
+                response.raise_for_status()
+
+                texts = ijson.sendable_list()
+                parser = ijson.items_coro(texts, 'candidates.item.content.parts.item.text')
+                for chunk in response.iter_bytes():
+                    parser.send(chunk)
+                    if texts:
+                        break
+                else:
+                    parser.close()
+
+                logger.info("gemini status=%d bytes=%d", response.status_code, response.num_bytes_downloaded)
+                break
+
+        ai_response_text = texts[0]
+        return orjson.loads(ai_response_text)
         
-    except requests.exceptions.HTTPError as http_err:
-        print(f"HTTP error occurred: {http_err}")
-        raise ConnectionError(f"API Error: Received status code {response.status_code}")
-    except requests.exceptions.RequestException as req_err:
-        print(f"Request error occurred: {req_err}")
-        raise ConnectionError(f"Network error while contacting Gemini API.")
-    except (KeyError, IndexError, json.JSONDecodeError) as e:
-        print(f"Failed to parse Gemini response. Error: {e}")
+    except httpx.HTTPStatusError as http_err:
+        logger.error("HTTP error occurred: %s", http_err)
+        status_code = http_err.response.status_code
+        error_class = GeminiUpstreamError if status_code >= 500 or status_code == 429 else ConnectionError
+        raise error_class(f"API Error: Received status code {status_code}")
+    except httpx.HTTPError as req_err:
+        logger.error("Request error occurred: %s", req_err)
+        raise GeminiUpstreamError(f"Network error while contacting Gemini API.")
+    except (IndexError, ijson.JSONError, json.JSONDecodeError, orjson.JSONDecodeError) as e:
+        logger.error("Failed to parse Gemini response. Error: %s", e)
         raise ValueError(f"Could not parse valid JSON from Gemini response.")
 
-# --- AI Logic Functions ---
-# (call_data_cleaning_ai and call_triage_ai remain unchanged)
-def call_data_cleaning_ai(raw_data):
-    """Calls Gemini to clean and format raw user data."""
-    system_prompt = """You are a data cleaning and formatting expert. Your task is to take raw, conversational user input and convert it into a structured, clean JSON object.
+# --- AI Prompt ---
+# Built once at import rather than re-allocated on every call.
+COMBINED_SYSTEM_PROMPT = """You are a data cleaning expert and an expert medical triage assistant for a hospital named 'MediCure'. You will receive raw, conversational patient input and must complete two steps.
+    STEP 1: Clean the data. Convert the raw input into a structured, clean JSON object under the key 'cleaned'.
     - Format 'dob' and 'appointmentDate' into a strict 'dd-mm-yyyy' format. Assume the current year is 2025 if not specified.
     - Format 'appointmentTime' into a strict 'hh:mm' 24-hour format. Interpret terms like 'morning' as 10:00, 'afternoon' as 14:00, and 'evening' as 18:00.
     - Clean up other text fields by correcting typos and ensuring proper capitalization.
-    Your response MUST be ONLY the JSON object."""
-    
-    payload = {
-        "systemInstruction": {"parts": [{"text": system_prompt}]},
-        "contents": [{"parts": [{"text": json.dumps(raw_data)}]}],
-        "generationConfig": {
-            "responseMimeType": "application/json",
-            "responseSchema": {
-                "type": "OBJECT",
-                "properties": {
-                    "name": {"type": "STRING"}, "dob": {"type": "STRING"}, "gender": {"type": "STRING"},
-                    "phone": {"type": "STRING"}, "email": {"type": "STRING"}, "address": {"type": "STRING"},
-                    "symptoms": {"type": "STRING"}, "history": {"type": "STRING"}, "medications": {"type": "STRING"},
-                    "allergies": {"type": "STRING"}, "conditions": {"type": "STRING"},
-                    "appointmentDate": {"type": "STRING"}, "appointmentTime": {"type": "STRING"}
-                }
-            }
-        }
-    }
-    return make_gemini_api_call(payload)
-
-def call_triage_ai(cleaned_data):
-    """Calls Gemini to perform medical triage based on cleaned data."""
-    system_prompt = """You are an expert medical triage assistant for a hospital named 'MediCure'. Your task is to analyze a patient's data and determine the most appropriate hospital department. You must also generate helpful, non-prescriptive precautions.
-    The available departments are: Cardiology, Orthopedics, Neurology, Dermatology, Gastroenterology, Pulmonology, Endocrinology, and General Physician.
+    STEP 2: Triage the patient based ONLY on the cleaned 'symptoms', 'history' and 'conditions' from STEP 1. Put the result under the key 'referral'.
+    - Determine the most appropriate hospital department. The available departments are: Cardiology, Orthopedics, Neurology, Dermatology, Gastroenterology, Pulmonology, Endocrinology, and General Physician.
+    - Generate helpful, non-prescriptive precautions.
     CRITICAL SAFETY INSTRUCTION: Your generated precautions MUST ALWAYS begin with a bolded disclaimer: "<b>Disclaimer: This is not medical advice. If your symptoms are severe or worsen, please visit the nearest emergency room immediately.</b>"
     Your response MUST be ONLY a valid JSON object."""
-    
-    triage_payload = {
-        "systemInstruction": {"parts": [{"text": system_prompt}]},
-        "contents": [{"parts": [{"text": f"Patient Data: {json.dumps({'symptoms': cleaned_data.get('symptoms'), 'history': cleaned_data.get('history'), 'conditions': cleaned_data.get('conditions')})}"}]}],
-        "generationConfig": {
-            "responseMimeType": "application/json",
-            "responseSchema": {
-                "type": "OBJECT",
-                "properties": {
-                    "department": {"type": "STRING"},
-                    "precautions": {"type": "STRING"}
-                },
-                "required": ["department", "precautions"]
-            }
+
+# --- AI Payload Skeleton ---
+# Everything except the per-request "contents" is constant, so the payload is
+# built once here and requests only shallow-merge their contents in. The top
+# level is read-only; nested parts stay plain dicts because orjson can't
+# serialize mappingproxy.
+CLEANED_DATA_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "name": {"type": "STRING"}, "dob": {"type": "STRING"}, "gender": {"type": "STRING"},
+        "phone": {"type": "STRING"}, "email": {"type": "STRING"}, "address": {"type": "STRING"},
+        "symptoms": {"type": "STRING"}, "history": {"type": "STRING"}, "medications": {"type": "STRING"},
+        "allergies": {"type": "STRING"}, "conditions": {"type": "STRING"},
+        "appointmentDate": {"type": "STRING"}, "appointmentTime": {"type": "STRING"}
+    }
+}
+
+REFERRAL_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "department": {"type": "STRING"},
+        "precautions": {"type": "STRING"}
+    },
+    "required": ["department", "precautions"]
+}
+
+COMBINED_SKELETON = MappingProxyType({
+    "systemInstruction": {"parts": [{"text": COMBINED_SYSTEM_PROMPT}]},
+    "generationConfig": {
+        "responseMimeType": "application/json",
+        "responseSchema": {
+            "type": "OBJECT",
+            "properties": {
+                "cleaned": CLEANED_DATA_SCHEMA,
+                "referral": REFERRAL_SCHEMA
+            },
+            "required": ["cleaned", "referral"]
         }
     }
-    return make_gemini_api_call(triage_payload)
+})
+
+# --- AI Logic Functions ---
+def call_combined_ai(raw_data):
+    """Calls Gemini once to clean the raw user data and triage it in the same request."""
+    return _call_combined_ai_text(orjson.dumps(raw_data).decode())
+
+def _call_combined_ai_text(raw_text):
+    """call_combined_ai for raw data that is already serialized to JSON text."""
+    payload = {**COMBINED_SKELETON, "contents": [{"parts": [{"text": raw_text}]}]}
+    result = make_gemini_api_call(payload)
+    try:
+        return result['cleaned'], result['referral']
+    except (KeyError, TypeError) as e:
+        logger.error("Combined Gemini response is missing a section. Error: %s", e)
+        raise ValueError("Could not parse valid JSON from Gemini response.")
+
+@lru_cache(maxsize=1024)
+def _cached_combined(key):
+    """Memoizes call_combined_ai on the canonical (sorted-key) JSON of the raw data.
+
+    The result is stored serialized so every hit hands back fresh dicts that
+    callers are free to mutate.
+    """
+    return orjson.dumps(_call_combined_ai_text(key.decode()))
+
+# --- Input Pre-validation ---
+# Cheap checks that run before any Gemini call, so submissions that would fail
+# (or are just spam) never cost a model round-trip.
+REQUIRED_FIELDS = ('symptoms',)
+MAX_RAW_DATA_CHARS = 20_000
+# Time-of-day words the cleaning prompt would map anyway; resolving them here
+# leaves Gemini only the free-form cases and makes repeat submissions share a
+# cache entry.
+TIME_OF_DAY = {'morning': '10:00', 'afternoon': '14:00', 'evening': '18:00'}
+
+def _prevalidate(raw_data):
+    """Returns True if raw_data is worth sending to Gemini."""
+    if not isinstance(raw_data, dict):
+        return False
+    if not any(str(raw_data.get(k) or '').strip() for k in REQUIRED_FIELDS):
+        return False
+    return sum(len(str(v)) for v in raw_data.values()) <= MAX_RAW_DATA_CHARS
+
+def _normalize_raw_data(raw_data):
+    """Resolves trivially formatted fields in Python and returns a new dict."""
+    normalized = dict(raw_data)
+    time_value = normalized.get('time')
+    if isinstance(time_value, str):
+        normalized['time'] = TIME_OF_DAY.get(time_value.strip().lower(), time_value)
+    return normalized
 
 # --- Routes ---
 @app.route('/')
@@ -127,9 +408,12 @@ def process_data():
         raw_data = request.json.get('userData')
         if not raw_data:
             return jsonify({"error": "No user data provided."}), 400
+        if not _prevalidate(raw_data):
+            return jsonify({"error": "Submitted details are missing symptoms or are too long."}), 400
+        raw_data = _normalize_raw_data(raw_data)
 
-        cleaned_data = call_data_cleaning_ai(raw_data)
-        triage_result = call_triage_ai(cleaned_data)
+        cache_key = orjson.dumps(raw_data, option=orjson.OPT_SORT_KEYS)
+        cleaned_data, triage_result = orjson.loads(_cached_combined(cache_key))
 
         final_appointment_data = {
             **cleaned_data,
@@ -140,16 +424,18 @@ def process_data():
             "bookingTimestampUTC": datetime.utcnow().isoformat()
         }
 
-        # *** NEW: Save to MongoDB instead of a file ***
-        insert_result = appointments_collection.insert_one(final_appointment_data)
-        print(f"\n--- Success! Saved appointment to MongoDB with ID: {insert_result.inserted_id} ---")
+        # Buffered for a batched insert so the client isn't kept waiting on MongoDB.
+        APPT_QUEUE.put(final_appointment_data)
 
         return jsonify(triage_result)
 
+    except GeminiUnavailableError as e:
+        logger.warning("Gemini is unavailable: %s", e)
+        return jsonify({"error": str(e)}), 503
     except (ValueError, ConnectionError) as e:
-        print(f"A known error occurred during processing: {e}")
+        logger.warning("A known error occurred during processing: %s", e)
         return jsonify({"error": str(e)}), 500
     except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+        logger.exception("An unexpected error occurred: %s", e)
         return jsonify({"error": "An unexpected server error occurred."}), 500
 
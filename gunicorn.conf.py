@@ -0,0 +1,15 @@
+# Gunicorn configuration, picked up automatically when starting `gunicorn app:app`
+# from the project directory.
+import multiprocessing
+import os
+
+# /process spends nearly all of its time waiting on Gemini, so each worker runs
+# its requests as gevent greenlets and overlaps that I/O instead of blocking
+# per request. app.py monkey-patches the stdlib so httpx and pymongo cooperate.
+worker_class = "gevent"
+# WEB_CONCURRENCY wins when set, since cpu_count() reports the host's CPUs
+# inside containers.
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_connections = 1000
+keepalive = 75
+timeout = 60